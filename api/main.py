@@ -1,137 +1,255 @@
-import base64
+import asyncio
+import hashlib
+import multiprocessing
+import pybase64 as base64
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from io import BytesIO
 
-import requests
+import aiohttp
 import uvicorn
 from typing import Optional
 
 from PIL import Image
 from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel
+from pydantic import BaseModel, PositiveInt
 from starlette.responses import RedirectResponse
 
 from src import ColorspaceModifier
-from src.convert import SUPPORTED_OPERATIONS, SUPPORTED_COLOR_CHANNEL_SHORTHANDS
+from src.convert import Action, Channel
 
 from PIL.Image import init
 init()
 from PIL.Image import EXTENSION
 
 SUPPORTED_IMAGE_TYPES = {k: f'image/{k.lower()}' for k in EXTENSION.values()}
+SUPPORTED_MIMETYPES = frozenset(SUPPORTED_IMAGE_TYPES.values())
 
 server = FastAPI()
 
+# Upper bound on concurrent URL input fetches, to be polite to upstream hosts
+URL_FETCH_LIMIT = 8
+
+# Encoded outputs of recent requests, keyed on the input image hash and the operation spec
+RESULT_CACHE_SIZE = 32
+RESULT_CACHE = OrderedDict()
+
+# Input images stored through /upload, keyed on upload id
+UPLOAD_STORE_SIZE = 64
+UPLOADS = OrderedDict()
+
+# Outputs are re-encoded as base64 straight away, so favour PNG encode speed over size
+PNG_COMPRESS_LEVEL = 1
+
+# Background jobs queued through /operations/submit, keyed on job id. The oldest jobs are dropped once the store is
+# full, so results that are never collected do not pile up.
+JOB_STORE_SIZE = 64
+JOBS = OrderedDict()
+
+
+@server.on_event('startup')
+async def open_http_session():
+    server.state.http_session = aiohttp.ClientSession()
+    # Created on startup, as a semaphore binds to the event loop it first blocks on
+    server.state.url_fetch_limit = asyncio.Semaphore(URL_FETCH_LIMIT)
+
+
+@server.on_event('startup')
+async def open_process_pool():
+    # Workers are started lazily, after the event loop has started threads, so they must not be forked from it
+    server.state.process_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('forkserver'))
+
+
+@server.on_event('shutdown')
+async def close_http_session():
+    await server.state.http_session.close()
+
+
+@server.on_event('shutdown')
+async def close_process_pool():
+    server.state.process_pool.shutdown()
+
 
 @server.get('/')
 def index():
     return RedirectResponse('/docs')
 
 
-def parse_file(data: str) -> bytes:
+async def parse_file(data: str) -> bytes:
     """
     Parse an input file specification. Supports:
     - data:mimetype;base64
     - url:weblink
+    - upload:id, for an image stored earlier through /upload
     :param data: The input file specification
     :return: The raw byte content of the file
     """
-    if ',' not in data:
+    # Only the short header before the first comma is parsed; the payload is sliced out once
+    comma = data.find(',')
+    if comma == -1:
         raise HTTPException(status_code=400, detail="Invalid data format; Must be prepended by type")
-    content_type, content_string = data.split(',')
+    content_type = data[:comma]
     if content_type.startswith('file:'):
         raise HTTPException(status_code=403, detail="Tried to access a local server resource")
+    content_string = data[comma + 1:]
     if content_type.startswith('data:'):
-        mimetype = content_type[content_type.index(':') + 1:content_type.index(';')]
-        if mimetype not in SUPPORTED_IMAGE_TYPES.values():
+        mimetype = content_type[5:].partition(';')[0]
+        if mimetype not in SUPPORTED_MIMETYPES:
             raise HTTPException(status_code=400, detail=f"Unsupported mimetype: {mimetype}")
         if content_type.endswith(';base64'):
-            return base64.b64decode(content_string)
+            return await asyncio.to_thread(base64.b64decode, content_string)
         raise HTTPException(status_code=400, detail=f"{content_type} decoding not implemented")
 
     elif content_type == 'url':
-        r = requests.get(content_string)
-        if r.status_code != 200:
-            raise HTTPException(status_code=r.status_code, detail=r.text)
-        return r.content
+        async with server.state.url_fetch_limit, server.state.http_session.get(content_string) as r:
+            if r.status != 200:
+                raise HTTPException(status_code=r.status, detail=await r.text())
+            return await r.read()
+
+    elif content_type == 'upload':
+        if content_string not in UPLOADS:
+            raise HTTPException(status_code=404, detail=f"Unknown upload {content_string}; It must be uploaded again")
+        UPLOADS.move_to_end(content_string)
+        return UPLOADS[content_string]
     raise HTTPException(status_code=400, detail=f"Invalid data format: {content_type}")
 
 
 def encode_output(output_buffer: BytesIO) -> str:
     """
-    Encode a PIL image into a base64 string with mimetype specification
-    :param data: The image to encode
+    Encode a saved image buffer into a base64 string with mimetype specification
+    :param output_buffer: The buffer holding the saved image
     :return: The base64 string with type specifier
     """
-    encoded = base64.b64encode(output_buffer.getvalue())
+    with output_buffer.getbuffer() as view:
+        encoded = base64.b64encode(view)
     return f"data:image/png;base64,{encoded.decode('utf-8')}"
 
 
-def do_operation(handle: ColorspaceModifier, operation: str, channels: list[str], params: Optional[list[any]]):
-    match operation:
-        case 'invert':
-            handle.invert(channels)
-        case 'offset':
-            handle.offset(zip(channels, [float(p) for p in params]))
-        case 'scale':
-            handle.scale(zip(channels, [float(p) for p in params]))
-        case 'clamp':
-            handle.clamp(zip(channels, [(a, b, (float(c) if c not in ['mean', 'median'] else c)) for a, b, c in params]))
-        case 'threshold':
-            handle.threshold(zip(channels, [(a, (float(b) if b not in ['mean', 'median'] else b)) for a, b in params]))
-        case _:
-            raise HTTPException(status_code=400, detail=f"Unsupported operation: {operation}")
+# Map each operation to the modifier method that applies it, and the parser for its per-channel parameters
+OPERATION_DISPATCH = {
+    'invert': (ColorspaceModifier.invert, None),
+    'offset': (ColorspaceModifier.offset, lambda params: [float(p) for p in params]),
+    'scale': (ColorspaceModifier.scale, lambda params: [float(p) for p in params]),
+    'clamp': (ColorspaceModifier.clamp,
+              lambda params: [(a, b, (float(c) if c not in ['mean', 'median'] else c)) for a, b, c in params]),
+    'threshold': (ColorspaceModifier.threshold,
+                  lambda params: [(a, (float(b) if b not in ['mean', 'median'] else b)) for a, b in params]),
+}
+
+
+def do_operation(handle: ColorspaceModifier, operation: Action, channels: list[Channel], params: Optional[list[any]]):
+    method, parse_params = OPERATION_DISPATCH[operation]
+    if parse_params is None:
+        method(handle, channels)
+    else:
+        method(handle, zip(channels, parse_params(params)))
+
+
+def open_input(raw_input: bytes, max_edge: Optional[int]) -> Image.Image:
+    """
+    Open an input image, downsizing it in place with Lanczos resampling if its longest edge is over max_edge
+    :param raw_input: The raw byte content of the input image
+    :param max_edge: The maximum edge length in pixels, or None to keep the full resolution
+    :return: The opened image
+    """
+    input_handle = Image.open(BytesIO(raw_input))
+    if max_edge is not None and max(input_handle.size) > max_edge:
+        input_handle.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+    return input_handle
 
 
 class Operation(BaseModel):
     auto_clamp: bool = False
-    action: str
-    channels: list[str]
+    action: Action
+    channels: list[Channel]
     params: Optional[list] = None
-    input: Optional[list[tuple[str, str]]]
+    input: Optional[list[tuple[str, str]]] = None
     output_format: Optional[str] = None
+    max_edge: Optional[PositiveInt] = None
+
+
+def process_operation(raw_input: bytes, data: Operation) -> str:
+    """
+    Perform a single operation on one input image. Runs in a worker process.
+    :param raw_input: The raw byte content of the input image
+    :param data: The operation to perform
+    :return: The resultant image as a base64 encoded image
+    """
+    input_handle = open_input(raw_input, data.max_edge)
+
+    # Create an output buffer for this image
+    output_handle = BytesIO()
+
+    # Create the modifier and perform the operation
+    convert = ColorspaceModifier(input_handle, data.auto_clamp)
+    do_operation(convert, data.action, data.channels, data.params)
+
+    # Save the output image
+    convert.save_image(output_handle, data.output_format, PNG_COMPRESS_LEVEL)
+
+    # Close the input image
+    convert.close_image()
+
+    # Encode the output
+    return encode_output(output_handle)
+
+
+def cache_key(raw_input: bytes, data: BaseModel) -> bytes:
+    """
+    Build the result cache key for running the given operation spec on an input image
+    :param raw_input: The raw byte content of the input image
+    :param data: The operation spec; the input files are left out of the key
+    :return: The cache key
+    """
+    return hashlib.blake2b(raw_input, digest_size=16).digest() + data.model_dump_json(exclude={'input'}).encode()
+
+
+async def run_cached(process, raw_input: bytes, data: BaseModel):
+    """
+    Run an image pipeline in the worker process pool, reusing the result of an identical recent request
+    :param process: The pipeline to run, process_operation or process_operations
+    :param raw_input: The raw byte content of the input image
+    :param data: The operation spec to pass to the pipeline
+    :return: The output of the pipeline
+    """
+    # Hashing releases the GIL, so large inputs are hashed off the event loop
+    key = await asyncio.to_thread(cache_key, raw_input, data)
+    if key in RESULT_CACHE:
+        RESULT_CACHE.move_to_end(key)
+        return RESULT_CACHE[key]
+
+    loop = asyncio.get_running_loop()
+    result = await loop.run_in_executor(server.state.process_pool, process, raw_input, data)
+    RESULT_CACHE[key] = result
+    if len(RESULT_CACHE) > RESULT_CACHE_SIZE:
+        RESULT_CACHE.popitem(last=False)
+    return result
 
 
 @server.post('/operation')
-async def api_operation(data: Operation):
+async def api_operation(data: Operation) -> dict[str, str]:
     """
     Perform a single operation on the given images and return the resultant images as base64 encoded images.
+    Each image is processed in the worker process pool so the event loop stays free to serve other requests.
+    If max_edge is set, larger images are downsized before processing; this trades output resolution for
+    a roughly quadratic cut in processing time.
     :param data: The operation to perform
     :return: The resultant image from the operation
     """
     # Check for incorrect data inputs
     if data.input is None:
         raise HTTPException(status_code=400, detail="Must specify input file / files")
-    if data.action not in SUPPORTED_OPERATIONS:
-        raise HTTPException(status_code=400, detail=f"Unsupported operation: {data.action}")
-    for c in data.channels:
-        if c not in SUPPORTED_COLOR_CHANNEL_SHORTHANDS:
-            raise HTTPException(status_code=400, detail=f"Unsupported channel: {c}")
-
-    files = {}
-    for input_name, input_data in data.input:
-        # Parse the input files
-        raw_input = parse_file(input_data)
-        input_handle = Image.open(BytesIO(raw_input))
+    if data.output_format is None:
+        data.output_format = 'default'
 
-        # Create an output buffer for this image
-        output_handle = BytesIO()
+    # Parse the input files, fetching any URL inputs concurrently
+    raw_inputs = await asyncio.gather(*[parse_file(input_data) for _, input_data in data.input])
 
-        # Create the modifier and perform the operation
-        convert = ColorspaceModifier(input_handle, data.auto_clamp)
-        do_operation(convert, data.action, data.channels, data.params)
-
-        # Save the output image
-        convert.save_image(output_handle)
-
-        # Close the input image
-        convert.close_image()
-
-        # Encode the output
-        if data.output_format is None:
-            data.output_format = 'default'
-        output_data = encode_output(output_handle.getvalue(), data.output_format)
-        files[input_name] = output_data
-    return files
+    # The workers only need the operation, so the inputs are not pickled into every task
+    spec = data.model_copy(update={'input': None})
+    outputs = await asyncio.gather(*[run_cached(process_operation, raw_input, spec) for raw_input in raw_inputs])
+    return {input_name: output_data for (input_name, _), output_data in zip(data.input, outputs)}
 
 
 class MultiOperation(BaseModel):
@@ -139,88 +257,150 @@ class MultiOperation(BaseModel):
     operations: list[Operation]
     input: list[tuple[str, str]]
     output_format: str = 'default'
+    max_edge: Optional[PositiveInt] = None
+
+
+def process_operations(raw_input: bytes, data: MultiOperation) -> list[str]:
+    """
+    Perform multiple operations on one input image. Runs in a worker process.
+    :param raw_input: The raw byte content of the input image
+    :param data: The operations to perform
+    :return: The requested intermediate images followed by the final image, as base64 encoded images
+    """
+    input_handle = open_input(raw_input, data.max_edge)
+
+    # Create an output buffer for this image; it is rewound and reused for every saved output
+    output_handle = BytesIO()
+
+    # Create the modifier and perform the operations
+    convert = ColorspaceModifier(input_handle, data.auto_clamp)
+
+    output_files = []
+    for op in data.operations:
+        do_operation(convert, op.action, op.channels, op.params)
+
+        # Save the output image
+        if op.output_format is not None:
+            convert.save_image(output_handle, op.output_format, PNG_COMPRESS_LEVEL)
+            output_data = encode_output(output_handle)
+            output_files.append(output_data)
+            output_handle.seek(0)
+            output_handle.truncate()
+
+    # Save the output image
+    convert.save_image(output_handle, compress_level=PNG_COMPRESS_LEVEL)
+
+    # Encode the output
+    output_data = encode_output(output_handle)
+    output_files.append(output_data)
+
+    # Close the input image
+    convert.close_image()
+
+    return output_files
+
+
+async def run_operations(data: MultiOperation) -> dict[str, list[str]]:
+    """
+    Perform multiple operations on the given images, which have already been checked
+    :param data: The operations to perform
+    :return: A list of images from the operations, for each input image
+    """
+    # Parse the input files, fetching any URL inputs concurrently
+    raw_inputs = await asyncio.gather(*[parse_file(input_data) for _, input_data in data.input])
+
+    # The workers only need the operations, so the inputs are not pickled into every task
+    spec = data.model_copy(update={'input': None})
+    outputs = await asyncio.gather(*[run_cached(process_operations, raw_input, spec) for raw_input in raw_inputs])
+    return {input_name: output_files for (input_name, _), output_files in zip(data.input, outputs)}
 
 
 @server.post('/operations')
-async def api_operations(data: MultiOperation):
+async def api_operations(data: MultiOperation) -> dict[str, list[str]]:
     """
     Perform multiple operations on the given images and return the resultant images as base64 encoded images.
+    If max_edge is set, larger images are downsized before the operations run, at the cost of output resolution.
     :param data: The operations to perform
     :return: A list of images from the operations
     """
-    files = {}
-    for input_name, input_data in data.input:
-        # Parse the input files
-        raw_input = parse_file(input_data)
-        input_handle = Image.open(BytesIO(raw_input))
+    return await run_operations(data)
 
-        # Create an output buffer for this image
-        output_handle = BytesIO()
 
-        # Create the modifier and perform the operation
-        convert = ColorspaceModifier(input_handle, data.auto_clamp)
+class JobResult(BaseModel):
+    status: str
+    files: Optional[dict[str, list[str]]] = None
 
-        output_files = []
-        for op in data.operations:
-            do_operation(convert, op.action, op.channels, op.params)
 
-            # Save the output image
-            if op.output_format is not None:
-                temp_handle = BytesIO()
-                convert.save_image(temp_handle, op.output_format)
-                output_data = encode_output(temp_handle.getvalue(), op.output_format)
-                output_files.append(output_data)
-
-        # Save the output image
-        convert.save_image(output_handle)
-
-        # Encode the output
-        if data.output_format is None:
-            data.output_format = 'default'
-        output_data = encode_output(output_handle)
-        output_files.append(output_data)
+@server.post('/operations/submit')
+async def api_submit_operations(data: MultiOperation) -> dict[str, str]:
+    """
+    Queue multiple operations on the given images and return straight away with a job id. The results are
+    collected from /operations/result/{job_id}, so long operation chains do not hold the connection open.
+    Only the most recent jobs are kept; older ones are cancelled or dropped.
+    :param data: The operations to perform
+    :return: The id of the queued job
+    """
+    job_id = uuid.uuid4().hex
+    task = asyncio.create_task(run_operations(data))
+    # Retrieve the exception of a failed job even if it is never polled
+    task.add_done_callback(lambda t: t.cancelled() or t.exception())
+    JOBS[job_id] = task
+    if len(JOBS) > JOB_STORE_SIZE:
+        _, dropped = JOBS.popitem(last=False)
+        dropped.cancel()
+    return {'job_id': job_id}
+
+
+@server.get('/operations/result/{job_id}')
+async def api_operations_result(job_id: str) -> JobResult:
+    """
+    Poll a job queued with /operations/submit. A finished job is removed once its result has been returned.
+    :param job_id: The id of the queued job
+    :return: The job status, and the images from the operations once it is done
+    """
+    if job_id not in JOBS:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    task = JOBS[job_id]
+    if not task.done():
+        return JobResult(status='pending')
+    del JOBS[job_id]
+    return JobResult(status='done', files=task.result())
 
-        # Close the input image
-        convert.close_image()
 
-        files[input_name] = output_files
-    return files
+class Upload(BaseModel):
+    data: str
 
 
+@server.post('/upload')
+async def api_upload(data: Upload) -> dict[str, str]:
+    """
+    Store an input image on the server. Operations can then reference it as upload,id instead of sending the whole
+    image again with every request. The least recently used uploads are dropped once the store is full.
+    :param data: The input file specification of the image to store
+    :return: The id of the stored image
+    """
+    raw_input = await parse_file(data.data)
+    upload_id = hashlib.blake2b(raw_input, digest_size=16).hexdigest()
+    UPLOADS[upload_id] = raw_input
+    UPLOADS.move_to_end(upload_id)
+    if len(UPLOADS) > UPLOAD_STORE_SIZE:
+        UPLOADS.popitem(last=False)
+    return {'id': upload_id}
 
-    # Parse the input files
-    input_name, input_data = data.input
-    raw_input = parse_file(input_data)
-    input_handle = Image.open(BytesIO(raw_input))
-    output_name, output_format = data.output
 
-    files = {
-        input_name: input_handle,
-        output_name: BytesIO()
-    }
+class UploadCheck(BaseModel):
+    ids: list[str]
 
-    # Create the modifier
-    convert = ColorspaceModifier(input_handle, data.auto_clamp)
 
-    for op in data.operations:
-        # Load input if specified
-        if op.input is not None:
-            name, raw_data = op.input
-            if name not in files:
-                data = parse_file(raw_data)
-                files[name] = handle = Image.open(BytesIO(data))
-            else:
-                handle = files[name]
-            convert.set_handle(handle)
-
-        # Perform the operation
-
-
-    # if data.action not in SUPPORTED_OPERATIONS:
-    #     raise HTTPException(status_code=400, detail=f"Unsupported operation: {data.action}")
-    # for c in data.channels:
-    #     if c not in SUPPORTED_COLOR_CHANNEL_SHORTHANDS:
-    #         raise HTTPException(status_code=400, detail=f"Unsupported channel: {c}")
+@server.post('/upload/check')
+async def api_upload_check(data: UploadCheck) -> dict[str, list[str]]:
+    """
+    Find the uploads that are no longer stored on the server, so a client can upload those images again before
+    referencing them in an operation.
+    :param data: The upload ids to look for
+    :return: The ids which are not stored
+    """
+    return {'missing': [upload_id for upload_id in data.ids if upload_id not in UPLOADS]}
 
 
 if __name__ == "__main__":
@@ -1,9 +1,10 @@
-import uuid
+from dataclasses import dataclass, fields
 from os import listdir
 from os.path import join
+from typing import Optional
 
 import plotly.graph_objects as go
-from dash import html, Output, Input, State, ALL, callback_context, dcc, ClientsideFunction, callback, MATCH
+from dash import html, Output, Input, State, ALL, dcc, ClientsideFunction, callback, MATCH, no_update, ctx
 import dash_bootstrap_components as dbc
 from dash_bootstrap_components import DropdownMenu
 from dash_bootstrap_templates import template_from_url
@@ -12,6 +13,54 @@ from dash_view import Builder
 from portal_utils import call_api, to_series, to_dataframe
 
 
+# Paths from a modification card to its row of widgets, and from that row to each widget, for get_widget
+ROW_PATH = (0, 0)
+ACTION_PATH = (0, 0, 0, -1)
+CHANNEL_ROWS_PATH = (2, 0, 0, -1)
+CHANNEL_VALUE_PATH = (0, 1, 'value')
+NUMERIC_GROUP_PATH = (4, 1, 0, 0)
+NUMERIC_OUTPUT_PATH = (6, 0, -1)
+KEYWORD_VALUE_PATH = (4, 1, 0, 0, 'value')
+KEYWORD_NUMERIC_GROUP_PATH = (6, 1, 0, 0)
+KEYWORD_NUMERIC_OUTPUT_PATH = (8, 0, -1)
+OUTPUT_PATH = (4, 0, -1)
+
+
+@dataclass(slots=True)
+class Operation:
+    action: str
+    channels: list
+    params: Optional[list] = None
+    output_format: Optional[str] = None
+
+    def to_payload(self) -> dict:
+        """
+        Build the API payload for this operation, leaving out unset fields so the server defaults apply. The fields
+        are referenced rather than copied.
+        :return: The operation as a dict
+        """
+        payload = {}
+        for field in fields(self):
+            value = getattr(self, field.name)
+            if value is not None:
+                payload[field.name] = value
+        return payload
+
+
+def get_widget(b, path):
+    """
+    Walk a component tree down a path of child indexes. The path may end with -1 to return the children, or with a
+    prop name to return that prop (None if it is not set).
+    """
+    for v in path:
+        if v == -1:
+            return b['props']['children']
+        elif isinstance(v, str):
+            return b['props'].get(v)
+        b = b['props']['children'][v]
+    return b
+
+
 def get_modification_actions():
     return [DropdownMenu(x) for x in ['Invert', 'Offset', 'Clamp', 'Scale', 'Threshold']]
 
@@ -31,50 +80,105 @@ def get_callbacks(app):
             upload['props']['className'] = 'small-upload';
             current[0] = upload;
             
+            const namespace = 'dash_html_components';
+            let added = new Array(filenames.length);
             for (let ix = 0; ix < filenames.length; ix++) {
                 let name = filenames[ix];
-                let content = contents[ix];
-                
-                let box = {
-                    'namespace': 'dash_html_components',
+                // Keep the decoded image in a blob, so the tree only holds a short object url instead of the data url
+                let data = contents[ix];
+                let binary = atob(data.substring(data.indexOf(',') + 1));
+                let bytes = new Uint8Array(binary.length);
+                for (let jx = 0; jx < binary.length; jx++) {
+                    bytes[jx] = binary.charCodeAt(jx);
+                }
+                let src = URL.createObjectURL(new Blob([bytes], {'type': data.substring(5, data.indexOf(';'))}));
+                added[ix] = {
+                    'namespace': namespace,
                     'type': 'Div',
                     'props': {
                         'className': 'photo-box',
                         'id': name,
                         'children': [
-                            {
-                                'namespace': 'dash_html_components',
-                                'type': 'Img',
-                                'props': {
-                                    'src': content
-                                }
-                            },
-                            {
-                                'namespace': 'dash_html_components',
-                                'type': 'Button',
-                                'props': {
-                                    'id': {'type': 'photo-remove', 'value': name},
-                                }
-                            }
+                            {'namespace': namespace, 'type': 'Img', 'props': {'src': src}},
+                            {'namespace': namespace, 'type': 'Button', 'props': {'id': {'type': 'photo-remove', 'value': name}}}
                         ]
                     }
                 };
-                
-                current.push(box);
             }
-            return [current, null];
+            let pending = {'names': filenames, 'contents': contents};
+            return [current.concat(added), null, pending];
         }
         """,
         Output('input-photos', 'children'),
         Output('upload-data', 'filename'),
+        Output('pending-uploads', 'data'),
         Input('upload-data', 'filename'),
         Input('upload-data', 'contents'),
         State('input-photos', 'children'),
     )
 
+    @app.callback(
+        Output('upload-ids', 'data'),
+        Output('pending-uploads', 'data', allow_duplicate=True),
+        Output('modification-error', 'children', allow_duplicate=True),
+        Output('reapply', 'data'),
+        Input('pending-uploads', 'data'),
+        State('upload-ids', 'data'),
+        background=True,
+        prevent_initial_call=True
+    )
+    def upload_photos(pending, uploads):
+        # Each image is sent to the server once here; operations then refer to it by its upload id
+        if pending is None:
+            raise PreventUpdate
+        failed = []
+        for name, content in zip(pending['names'], pending['contents']):
+            r = call_api('upload', 'post', {'data': content})
+            # A photo without an upload id is uploaded again when the modifications are applied
+            uploads[name] = None if r is None else r['id']
+            if r is None:
+                failed.append(name)
+        if failed:
+            return uploads, None, f'Failed to upload {", ".join(failed)}', no_update
+        # Photos uploaded again for an apply go straight on to that apply
+        return uploads, None, no_update, True if pending.get('retry') else no_update
+
+    app.clientside_callback(
+        """
+        async function(names, current) {
+            if (names == null) {
+                return window.dash_clientside.no_update;
+            }
+            // Only the blobs behind the displayed photos are kept, so the data urls are read back from them
+            let read = function(blob) {
+                return new Promise((resolve, reject) => {
+                    let reader = new FileReader();
+                    reader.onload = () => resolve(reader.result);
+                    reader.onerror = () => reject(reader.error);
+                    reader.readAsDataURL(blob);
+                });
+            };
+            let contents = [];
+            for (let name of names) {
+                let photo = current.find((child, ix) => ix > 0 && child['props']['id'] == name);
+                let response = await fetch(photo['props']['children'][0]['props']['src']);
+                contents.push(await read(await response.blob()));
+            }
+            return {'names': names, 'contents': contents, 'retry': true};
+        }
+        """,
+        Output('pending-uploads', 'data', allow_duplicate=True),
+        Input('reupload', 'data'),
+        State('input-photos', 'children'),
+        prevent_initial_call=True
+    )
+
     app.clientside_callback(
         """
         function(n_clicks, current) {
+            for (let ix = 1; ix < current.length; ix++) {
+                URL.revokeObjectURL(current[ix]['props']['children'][0]['props']['src']);
+            }
             let upload = current[0];
             upload['props']['className'] = 'upload';
             let nothing = {
@@ -85,11 +189,12 @@ def get_callbacks(app):
                     'style': {'textAlign': 'center'}
                 }
             };
-            return [upload, nothing];
+            return [upload, nothing, {}];
         }
         """,
         Output('input-photos', 'children', allow_duplicate=True),
         Output('output-photos', 'children', allow_duplicate=True),
+        Output('upload-ids', 'data', allow_duplicate=True),
         Input('clear-input', 'n_clicks'),
         State('input-photos', 'children'),
         prevent_initial_call=True
@@ -97,63 +202,51 @@ def get_callbacks(app):
 
     app.clientside_callback(
         """
-            function(children) {
-                if (children == null) {
-                    return window.dash_clientside.no_update;
-                }
-                if (children.length == 1) {
-                    return {'display': 'none'};
-                }
-                return {'display': 'block'};
-            }
-        """,
-        Output('clear-input', 'style'),
-        Input('input-photos', 'children'),
-    )
-
-    app.clientside_callback(
-        """
-        function(n_clicks, input_current, output_current) {
+        function(n_clicks, input_current, output_current, uploads) {
             let button = window.dash_clientside.callback_context.triggered[0];
             if (button['value'] == null) {
                 return window.dash_clientside.no_update;
             }
             
-            let photo_id = button['prop_id'].substring(32, button['prop_id'].length - 11);
-            if (photo_id == null) {
-                return window.dash_clientside.no_update;
-            }
-            for (let ix = 1; ix < input_current.length; ix++) {
-                let child = input_current[ix];
-                let child_button = child['props']['children'][1]['props']['id'];
-                if (child_button['value'] == photo_id) {
-                    input_current.splice(ix, 1);
-                    break;
-                }
+            // The prop_id is the JSON encoded pattern id followed by '.n_clicks'
+            let prop_id = button['prop_id'];
+            let photo_id = JSON.parse(prop_id.substring(0, prop_id.lastIndexOf('.')))['value'];
+            let is_photo = function(child) {
+                let children = child['props']['children'];
+                return Array.isArray(children) && children[1]['props']['id']['value'] == photo_id;
+            };
+            
+            // Skip the upload box at the front of the input photos
+            let input_ix = input_current.findIndex((child, ix) => ix > 0 && is_photo(child));
+            if (input_ix != -1) {
+                URL.revokeObjectURL(input_current[input_ix]['props']['children'][0]['props']['src']);
+                input_current.splice(input_ix, 1);
             }
-            for (let ix = 0; ix < output_current.length; ix++) {
-                let child = output_current[ix];
-                let child_button = child['props']['children'][1]['props']['id'];
-                if (child_button['value'] == photo_id) {
-                    output_current.splice(ix, 1);
-                    break;
+            if (Array.isArray(output_current)) {
+                let output_ix = output_current.findIndex(is_photo);
+                if (output_ix != -1) {
+                    output_current.splice(output_ix, 1);
                 }
             }
             
+            delete uploads[photo_id];
+            
             if (input_current.length == 1) {
                 let upload = input_current[0];
                 upload['props']['className'] = 'upload';
                 input_current[0] = upload;
             }
             
-            return [input_current, output_current];
+            return [input_current, output_current, uploads];
         }
         """,
         Output('input-photos', 'children', allow_duplicate=True),
         Output('output-photos', 'children', allow_duplicate=True),
+        Output('upload-ids', 'data', allow_duplicate=True),
         Input({'type': 'photo-remove', 'value': ALL}, 'n_clicks'),
         State('input-photos', 'children'),
         State('output-photos', 'children'),
+        State('upload-ids', 'data'),
         prevent_initial_call=True
     )
 
@@ -163,22 +256,6 @@ def get_callbacks(app):
         [Input("modification-list", "id")],
     )
 
-    app.clientside_callback(
-        """
-            function(children) {
-                if (children == null) {
-                    return true;
-                }
-                if (children.length == 0) {
-                    return true;
-                }
-                return false;
-            }
-        """,
-        Output('clear-modifications', 'disabled'),
-        Input('modification-list', 'children'),
-    )
-
     app.clientside_callback(
         """
             function(children) {
@@ -190,32 +267,47 @@ def get_callbacks(app):
         prevent_initial_call=True
     )
 
-    @app.callback(
+    app.clientside_callback(
+        """
+        function(n_clicks, current, templates) {
+            let trigger = window.dash_clientside.callback_context.triggered[0];
+            if (trigger == null || trigger['prop_id'] == '.' || trigger['value'] == null) {
+                return window.dash_clientside.no_update;
+            }
+            let name = JSON.parse(trigger['prop_id'].slice(0, trigger['prop_id'].lastIndexOf('.')))['value'];
+            // randomUUID is only available in secure contexts, so fall back to random bytes over plain http
+            let base_id;
+            if (typeof crypto.randomUUID == 'function') {
+                base_id = crypto.randomUUID().replaceAll('-', '');
+            } else {
+                let bytes = crypto.getRandomValues(new Uint8Array(16));
+                base_id = Array.from(bytes, byte => byte.toString(16).padStart(2, '0')).join('');
+            }
+            let replace_id = function(node) {
+                if (Array.isArray(node)) {
+                    node.forEach(replace_id);
+                } else if (node != null && typeof node == 'object') {
+                    let props = node['props'];
+                    if (props == null) {
+                        return;
+                    }
+                    if (props['id'] != null && props['id']['value'] == templates['base_id']) {
+                        props['id']['value'] = base_id;
+                    }
+                    replace_id(props['children']);
+                }
+            };
+            let child = structuredClone(templates['rows'][name]);
+            replace_id(child);
+            return (current == null ? [] : current).concat([child]);
+        }
+        """,
         Output('modification-list', 'children', allow_duplicate=True),
         Input({'type': 'add-modification', 'value': ALL}, 'n_clicks'),
         State('modification-list', 'children'),
+        State('modification-templates', 'data'),
         prevent_initial_call='initial_duplicate'
     )
-    def add_modification(n_clicks, current):
-        if current is None:
-            current = []
-        trigger = callback_context.triggered_id
-        if trigger is None:
-            raise PreventUpdate
-        name = trigger['value']
-        base_id = uuid.uuid4().hex
-        if name == 'Invert':
-            child = Builder.build_template(app.ctx, 'ModificationRow', name, base_id)
-        elif name == 'Offset':
-            child = Builder.build_template(app.ctx, 'ModificationRowNumeric', name, base_id, 'Offset Value')
-        elif name == 'Scale':
-            child = Builder.build_template(app.ctx, 'ModificationRowNumeric', name, base_id, 'Scale Value')
-        elif name == 'Clamp':
-            child = Builder.build_template(app.ctx, 'ModificationRowKeywordNumeric', name, base_id, 'Clamp Type', ['Min', 'Max'], 'Clamp Value')
-        else:  # Threshold
-            child = Builder.build_template(app.ctx, 'ModificationRowNumeric', name, base_id, 'Threshold Value')
-        current.append(child)
-        return current
 
     app.clientside_callback(
         """
@@ -256,102 +348,126 @@ def get_callbacks(app):
     app.clientside_callback(
         """
         function(photos, modifications) {
-            if (photos == null || modifications == null) {
-                return true;
+            const no_update = window.dash_clientside.no_update;
+            let triggered = window.dash_clientside.callback_context.triggered.map(t => t['prop_id']);
+            let photos_changed = triggered.includes('input-photos.children');
+            let modifications_changed = triggered.includes('modification-list.children');
+            if (!photos_changed && !modifications_changed) {
+                photos_changed = true;
+                modifications_changed = true;
+            }
+
+            let style = no_update;
+            if (photos_changed && photos != null) {
+                style = {'display': photos.length == 1 ? 'none' : 'block'};
+            }
+            let clear_disabled = no_update;
+            if (modifications_changed) {
+                clear_disabled = modifications == null || modifications.length == 0;
             }
-            return photos.length <= 1 || modifications.length == 0;
+            let apply_disabled = photos == null || modifications == null || photos.length <= 1 || modifications.length == 0;
+            return [style, apply_disabled, clear_disabled];
         }
         """,
+        Output('clear-input', 'style'),
         Output('apply-modifications', 'disabled'),
+        Output('clear-modifications', 'disabled'),
         Input('input-photos', 'children'),
         Input('modification-list', 'children'),
-        prevent_initial_call=True
     )
 
-    def get_widget(b, v, *args):
-        if v == -1:
-            return b['props']['children']
-        elif isinstance(v, str):
-            if v in b['props']:
-                return b['props'][v]
-            return None
-        else:
-            c = b['props']['children'][v]
-            if len(args) > 0:
-                return get_widget(c, *args)
-            return c
-
     @app.callback(
         Output('output-photos', 'children'),
         Output('modification-error', 'children'),
+        Output('reupload', 'data'),
         Input('apply-modifications', 'n_clicks'),
-        State('input-photos', 'children'),
+        Input('reapply', 'data'),
+        State('upload-ids', 'data'),
         State('modification-list', 'children'),
-        State('auto-clamp', 'children')
+        State('auto-clamp', 'children'),
+        background=True,
+        running=[(Output('apply-modifications', 'disabled'), True, False)],
+        progress=Output('modification-error', 'children')
     )
-    def apply_modifications(n_clicks, photos, modifications, clamp):
+    def apply_modifications(set_progress, n_clicks, reapply, uploads, modifications, clamp):
         if n_clicks is None:
             raise PreventUpdate
 
         operations = {'auto_clamp': clamp == 'Auto Clamp ON', 'input': [], 'operations': [], 'output_format': 'default'}
 
-        for p in photos[1:]:
-            src = get_widget(p, 0, 'src')
-            name = get_widget(p, 1, 'id')['value']
-            print(name)
-            # TODO: Get Photo name from id
-            operations['input'].append((name, src))
+        # Photos which failed to upload, or which the server has since dropped, have to be uploaded again first
+        missing = [name for name, upload_id in uploads.items() if upload_id is None]
+        upload_ids = [upload_id for upload_id in uploads.values() if upload_id is not None]
+        if upload_ids:
+            r = call_api('upload/check', 'post', {'ids': upload_ids})
+            if r is not None:
+                missing.extend(name for name, upload_id in uploads.items() if upload_id in r['missing'])
+        if missing:
+            # Only upload again once per click, so a server that keeps dropping the photos can't loop forever
+            if ctx.triggered_id == 'reapply':
+                return no_update, f'The server dropped {", ".join(missing)}; Apply the modifications again', no_update
+            return no_update, f'Uploading {", ".join(missing)} again...', missing
+
+        for name, upload_id in uploads.items():
+            operations['input'].append((name, f'upload,{upload_id}'))
 
         message = None
         for ixm, m in enumerate(modifications):
-            name = get_widget(m, 0, 0, 0, 0, 0, -1).lower()
+            row = get_widget(m, ROW_PATH)
+            name = get_widget(row, ACTION_PATH).lower()
 
-            operation = {'action': name, 'channels': []}
+            operation = Operation(name, [])
 
-            for ix in range(4):
-                opt = get_widget(m, 0, 0, 2, 0, 0, ix, 0, 1, 'value')
-                if opt is not None:
-                    operation['channels'] += [x.lower() for x in opt]
-            if len(operation['channels']) == 0:
+            channels = operation.channels
+            for channel_row in get_widget(row, CHANNEL_ROWS_PATH):
+                opt = get_widget(channel_row, CHANNEL_VALUE_PATH)
+                if opt:
+                    channels.extend(map(str.lower, opt))
+            if not channels:
                 message = f'Mod ({ixm}): Must select 1 or more channels'
+                break
 
             params = None
             if name in ('offset', 'scale', 'threshold'):
-                group = get_widget(m, 0, 0, 4, 1, 0, 0)
-                select = get_widget(group, 0, 'value')
-                value = get_widget(group, 1, 'value')
-                if message is None and (select is None or value is None):
+                group = get_widget(row, NUMERIC_GROUP_PATH)
+                select = get_widget(group, (0, 'value'))
+                value = get_widget(group, (1, 'value'))
+                if select is None or value is None:
                     message = f'Mod ({ixm}): Must select a value or enter a value or both'
+                    break
                 params = [select, value]
-                output = get_widget(m, 0, 0, 6, 0, -1)
+                output = get_widget(row, NUMERIC_OUTPUT_PATH)
             elif name in ('clamp', ):
-                keyword = get_widget(m, 0, 0, 4, 1, 0, 0, 'value')
-                if message is None and keyword is None:
+                keyword = get_widget(row, KEYWORD_VALUE_PATH)
+                if keyword is None:
                     message = f'Mod ({ixm}): Must select a valid clamp type'
-                group = get_widget(m, 0, 0, 6, 1, 0, 0)
-                select = get_widget(group, 0, 'value')
-                value = get_widget(group, 1, 'value')
+                    break
+                group = get_widget(row, KEYWORD_NUMERIC_GROUP_PATH)
+                select = get_widget(group, (0, 'value'))
+                value = get_widget(group, (1, 'value'))
                 params = [keyword, select, value]
-                output = get_widget(m, 0, 0, 8, 0, -1)
+                output = get_widget(row, KEYWORD_NUMERIC_OUTPUT_PATH)
             else:
-                output = get_widget(m, 0, 0, 4, 0, -1)
-            operation['params'] = params
-            operation['input'] = None
-            operation['auto_clamp'] = False
-            operation['output_format'] = 'default' if output == 'Output' else None
+                output = get_widget(row, OUTPUT_PATH)
+            operation.params = params
+            # The input and clamping are set once for the whole request, so only the output is sent per operation
+            if output == 'Output':
+                operation.output_format = 'default'
             operations['operations'].append(operation)
 
         if message is not None:
-            return html.H2('Nothing to Show', style={'textAlign': 'center'}), message
+            return html.H2('Nothing to Show', style={'textAlign': 'center'}), message, no_update
 
+        operations['operations'] = [operation.to_payload() for operation in operations['operations']]
+        set_progress(f'Applying {len(operations["operations"])} modifications to {len(operations["input"])} photos...')
         r = call_api('operations', 'post', operations)
         if r is None:
             message = 'The server failed to generate the output'
-            return html.H2('Nothing to Show', style={'textAlign': 'center'}), message
+            return html.H2('Nothing to Show', style={'textAlign': 'center'}), message, no_update
 
         output = []
         for name, output_list in r.items():
             for output_data in output_list:
                 photo = Builder.build_template(app.ctx, 'Photo', name, output_data)
                 output.append(photo)
-        return output, None
+        return output, None, no_update
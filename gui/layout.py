@@ -1,4 +1,7 @@
+from functools import lru_cache
+
 import dash_bootstrap_components as dbc
+from dash import dcc
 
 from portal_utils import ThemeDropDown
 from dash_view import Builder
@@ -7,11 +10,41 @@ from dash_view import Builder
 
 THEMES = {'lux': dbc.themes.LUX, 'darkly': dbc.themes.DARKLY}
 
+# The template and arguments used to build the row for each modification. The rows are built once with a placeholder
+# id, which the add modification callback replaces in the browser.
+MODIFICATION_TEMPLATES = {
+    'Invert': ('ModificationRow', ),
+    'Offset': ('ModificationRowNumeric', 'Offset Value'),
+    'Scale': ('ModificationRowNumeric', 'Scale Value'),
+    'Clamp': ('ModificationRowKeywordNumeric', 'Clamp Type', ['Min', 'Max'], 'Clamp Value'),
+    'Threshold': ('ModificationRowNumeric', 'Threshold Value'),
+}
+TEMPLATE_BASE_ID = 'template'
+
+
+@lru_cache(maxsize=None)
+def load_context(filename='layout.kv'):
+    """
+    Parse a layout file once, and share the parsed context between the layout and the callbacks
+    :param filename: The layout file to load
+    :return: The parsed context
+    """
+    return Builder.load_file(filename)
+
+
+@lru_cache(maxsize=None)
+def make_modification_templates():
+    context = load_context()
+    rows = {}
+    for name, (template, *args) in MODIFICATION_TEMPLATES.items():
+        rows[name] = Builder.build_template(context, template, name, TEMPLATE_BASE_ID, *args).to_plotly_json()
+    return {'base_id': TEMPLATE_BASE_ID, 'rows': rows}
+
 
 def make_layout():
-    context = Builder.load_file('layout.kv')
-    context.arguments.update(context.imports)
-    layout = Builder.build_layout(context.layout, context.arguments, context.style)
+    context = load_context()
+    arguments = {**context.arguments, **context.imports}
+    layout = Builder.build_layout(context.layout, arguments, context.style)
 
     # The theme changer component. If you want to move the dropdown, you can, but the component must be in the app.
     theme_selector = ThemeDropDown(id='theme', options=THEMES)
@@ -19,4 +52,8 @@ def make_layout():
     # It is strongly recommended that you leave this code, modifying only above.
     # The Container and Location along with the update_theme in the callbacks.py
     # allow for the app to respond to theme changes that come from the PSL Portal (when embedded)
-    return dbc.Container([theme_selector, layout], id='root', fluid=True, className="dbc")
+    # Images are sent to the server once when uploaded, and then referred to by their upload ids
+    stores = [dcc.Store(id='pending-uploads'), dcc.Store(id='upload-ids', data={})]
+    stores.extend([dcc.Store(id='reupload'), dcc.Store(id='reapply')])
+    stores.append(dcc.Store(id='modification-templates', data=make_modification_templates()))
+    return dbc.Container([theme_selector, layout, *stores], id='root', fluid=True, className="dbc")
@@ -1,11 +1,10 @@
-from dash import Dash
+import diskcache
+from dash import Dash, DiskcacheManager
 
 import dash_bootstrap_components as dbc
 
 from callbacks import get_callbacks
-from layout import make_layout
-
-from dash_view import Builder
+from layout import load_context, make_layout
 
 DEBUG = True
 
@@ -15,10 +14,12 @@ dbc_css = "https://cdn.jsdelivr.net/gh/AnnMarieW/dash-bootstrap-templates/dbc.mi
 dragula = "https://epsi95.github.io/dash-draggable-css-scipt/dragula.css"
 dragula_js = "https://cdnjs.cloudflare.com/ajax/libs/dragula/3.7.2/dragula.min.js"
 dragula_local_js = "https://epsi95.github.io/dash-draggable-css-scipt/script.js"
-app = Dash(__name__, suppress_callback_exceptions=True,
+# Long running callbacks, like applying the modifications, run in a background process instead of blocking the server
+background_callback_manager = DiskcacheManager(diskcache.Cache('./cache'))
+app = Dash(__name__, suppress_callback_exceptions=True, background_callback_manager=background_callback_manager,
            external_stylesheets=[DEFAULT_THEME, dbc_css, dragula],
            external_scripts=[dragula_local_js, dragula_js])
-app.ctx = Builder.load_file('layout.kv')
+app.ctx = load_context()
 app.layout = make_layout
 get_callbacks(app)
 server = app.server
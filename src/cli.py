@@ -1,22 +1,21 @@
 import argparse
 import textwrap
 
-from os.path import exists
+from functools import lru_cache
+from os.path import basename, exists
 from sys import argv
 from argparse import ArgumentParser
 
 from convert import SUPPORTED_COLOR_CHANNELS, SUPPORTED_OPERATIONS, ColorspaceModifier
 
+PROGRAM = basename(argv[0])
 
-def first_index(input_list, iterable, start=0):
-    input_list = list(map(str.lower, input_list[start:]))
-    first = len(input_list)
-    for item in iterable:
-        try:
-            first = min(first, input_list.index(item))
-        except ValueError:
-            continue
-    return first + start
+
+def first_index(lowered, operations, start=0):
+    for ix in range(start, len(lowered)):
+        if lowered[ix] in operations:
+            return ix
+    return len(lowered)
 
 
 def parse_operation(args):
@@ -75,9 +74,9 @@ def parse_operation(args):
     return arg_parser.parse_args(args)
 
 
-def parse_command(command, args, need_input=True):
-    program = argv[0].split('/' if '/' in argv[0] else '\\')[-1]
-    arg_parser = ArgumentParser(prefix_chars='-+', prog=program + ' ' + command)
+@lru_cache(maxsize=None)
+def command_parser(command, need_input=True):
+    arg_parser = ArgumentParser(prefix_chars='-+', prog=PROGRAM + ' ' + command)
     if need_input:
         arg_parser.add_argument('input', help='The input image')
     else:
@@ -106,7 +105,11 @@ def parse_command(command, args, need_input=True):
             arg_parser.add_argument(f'+{shorthand}', f'--{channel}', nargs=2, metavar='clamp mode value', help=description, default=argparse.SUPPRESS)
     else:
         raise ValueError(f'Unsupported command {command}')
-    return arg_parser.parse_args(args)
+    return arg_parser
+
+
+def parse_command(command, args, need_input=True):
+    return command_parser(command, need_input).parse_args(args)
 
 
 def run_commands(commands, debug, clamp=True):
@@ -135,20 +138,22 @@ def run_commands(commands, debug, clamp=True):
             elif name == 'invert':
                 image['handle'].invert([k])
             elif name == 'offset':
-                image['handle'].offset([tuple([k, float(v[0])])])
+                image['handle'].offset([(k, float(v[0]))])
             elif name == 'scale':
-                image['handle'].scale([tuple([k, float(v[0])])])
+                image['handle'].scale([(k, float(v[0]))])
             elif name == 'threshold':
-                image['handle'].threshold([tuple([k, float(v[0]) if v[0] not in ('mean', 'median') else v[0]])])
+                image['handle'].threshold([(k, float(v[0]) if v[0] not in ('mean', 'median') else v[0])])
             elif name == 'clamp':
-                image['handle'].clamp([tuple([k, v[0], float(v[1]) if v[1] not in ('mean', 'median') else v[1]])])
+                image['handle'].clamp([(k, v[0], float(v[1]) if v[1] not in ('mean', 'median') else v[1])])
+        # Only save an intermediate image if a later command moves on to a different output,
+        # otherwise it would be overwritten by the next save anyway
         if image['output_name'] is not None and command_ix != len(commands) - 1:
-            with open(image['output_name'], 'rb') as f:
-                image['handle'].save_image(f)
+            next_output = commands[command_ix + 1][1].output
+            if next_output is not None and next_output != image['output_name']:
+                image['handle'].save_image(image['output_name'])
     if image['output_name'] is None:
         image['output_name'] = image['input_name']
-    with open(image['output_name'], 'rb') as f:
-        image['handle'].save_image(f)
+    image['handle'].save_image(image['output_name'])
 
 
 def main():
@@ -162,9 +167,11 @@ def main():
     debug = False
     no_clamp = False
     commands = []
+    lowered = [arg.lower() for arg in argv]
+    operations = set(SUPPORTED_OPERATIONS)
     while end < len(argv):
         start = end
-        end = first_index(argv, SUPPORTED_OPERATIONS, start + 1)
+        end = first_index(lowered, operations, start + 1)
 
         parsed = parse_operation(argv[start:start + 1])
         values = parse_command(parsed.command, argv[start + 1:end], need_input)
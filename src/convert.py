@@ -1,6 +1,8 @@
 from __future__ import annotations
 
-from typing import BinaryIO
+from enum import Enum
+from functools import lru_cache
+from typing import BinaryIO, Union
 
 import numpy as np
 from PIL import Image
@@ -40,8 +42,19 @@ SUPPORTED_PIL_MODES = {
     'LA': ['luminance', 'alpha'],
     'HSV': ['hue', 'saturation', 'value'],
 }
+# The conversions that only add or drop the alpha channel
+ALPHA_CONVERSIONS = {('RGB', 'RGBA'), ('RGBA', 'RGB'), ('L', 'LA'), ('LA', 'L')}
+
+# The position of each channel shorthand in each format
+CHANNEL_INDEX = {mode: {shorthand: ix for ix, shorthand in enumerate(mode)} for mode in SUPPORTED_PIL_MODES}
+
 SUPPORTED_OPERATIONS = ['invert', 'offset', 'clamp', 'scale', 'threshold']
 
+# Enum forms of the supported operations and channel shorthands, for validating requests up front
+Action = Enum('Action', {operation: operation for operation in SUPPORTED_OPERATIONS}, type=str, module=__name__)
+Channel = Enum('Channel', {shorthand: shorthand for shorthand in SUPPORTED_COLOR_CHANNEL_SHORTHANDS}, type=str,
+               module=__name__)
+
 SUPPORTED_KEYWORD_PARAMS = {
     'mean': np.mean,
     'median': np.median,
@@ -51,12 +64,75 @@ SUPPORTED_KEYWORD_PARAMS = {
     'std': np.std,
 }
 
+LEVELS = np.arange(256)
+
+
+def _histogram_median(hist: np.ndarray) -> float:
+    """
+    Return the median level of a 256 bin histogram, averaging the two middle values for an even count
+    :param hist: The count of each 8-bit level
+    :return: The median level
+    """
+    counts = np.cumsum(hist)
+    n = counts[-1]
+    lower, upper = np.searchsorted(counts, [(n - 1) // 2, n // 2], side='right')
+    return (lower + upper) / 2
+
+
+def _histogram_std(hist: np.ndarray) -> float:
+    """
+    Return the standard deviation of the levels in a 256 bin histogram
+    :param hist: The count of each 8-bit level
+    :return: The standard deviation, in levels
+    """
+    mean = hist @ LEVELS / hist.sum()
+    return np.sqrt(hist @ (LEVELS - mean) ** 2 / hist.sum())
+
+
+# The keyword statistics computed from a channel's histogram, in 8-bit levels
+HISTOGRAM_KEYWORD_PARAMS = {
+    'mean': lambda hist: hist @ LEVELS / hist.sum(),
+    'median': _histogram_median,
+    'min': lambda hist: np.flatnonzero(hist)[0],
+    'max': lambda hist: np.flatnonzero(hist)[-1],
+    'sum': lambda hist: hist @ LEVELS,
+    'std': _histogram_std,
+}
+
 SUPPORTED_CLAMP_MODES = {
     'min': fmin,
     'max': fmax
 }
 
 
+# For each format, the closest formats that add each channel it is missing
+FORMAT_CHANNELS = {
+    'RGB': {
+        'RGBA': ['A'],
+        'HSV': ['H', 'S', 'V'],
+        'L': ['L'],
+    },
+    'RGBA': {
+        'HSV': ['H', 'S', 'V'],
+        'L': ['L'],
+    },
+    'HSV': {
+        'RGBA': ['R', 'G', 'B', 'A'],
+        'LA': ['L'],
+    },
+    'L': {
+        'RGB': ['R', 'G', 'B'],
+        'RGBA': ['A'],
+        'HSV': ['H', 'S', 'V'],
+    },
+    'LA': {
+        'RGBA': ['R', 'G', 'B'],
+        'HSV': ['H', 'S', 'V'],
+    }
+}
+
+
+@lru_cache(maxsize=None)
 def _get_format(current: str, k: str) -> str:
     """
     Return the closet format to the current format that supports the given channel
@@ -64,33 +140,7 @@ def _get_format(current: str, k: str) -> str:
     :param k: The requested channel
     :return: The closest supported format
     """
-
-    supported = {
-        'RGB': {
-            'RGBA': ['A'],
-            'HSV': ['H', 'S', 'V'],
-            'L': ['L'],
-        },
-        'RGBA': {
-            'HSV': ['H', 'S', 'V'],
-            'L': ['L'],
-        },
-        'HSV': {
-            'RGBA': ['R', 'G', 'B', 'A'],
-            'LA': ['L'],
-        },
-        'L': {
-            'RGB': ['R', 'G', 'B'],
-            'RGBA': ['A'],
-            'HSV': ['H', 'S', 'V'],
-        },
-        'LA': {
-            'RGBA': ['R', 'G', 'B'],
-            'HSV': ['H', 'S', 'V'],
-        }
-    }
-
-    for mode, channels in supported[current].items():
+    for mode, channels in FORMAT_CHANNELS[current].items():
         if k in channels:
             return mode
     raise ValueError(f'No format supports the channel {k}')
@@ -98,26 +148,62 @@ def _get_format(current: str, k: str) -> str:
 
 def _clamp(v: np.ndarray) -> np.ndarray:
     """
-    Clamp a float value between 0 and 1.
+    Clamp a float value between 0 and 1, in place.
     :param v: The value to clamp
-    :return: A new value between 0 and 1
+    :return: The same value, between 0 and 1
     """
-    return fmax(fmin(v, 1.0), 0.0)
+    return np.clip(v, 0.0, 1.0, out=v)
+
+
+# The operations that can be applied to an 8-bit channel through a lookup table, as functions of normalized values
+TABLE_OPERATIONS = {
+    'invert': lambda x: 1.0 - x,
+    'offset': lambda x, offset: x + offset,
+    'scale': lambda x, factor: x * factor,
+    'threshold': lambda x, t: np.where(x >= t, 1.0, 0.0),
+    'clamp': lambda x, mode, t: SUPPORTED_CLAMP_MODES[mode](x, t),
+}
+
+
+@lru_cache(maxsize=256)
+def _lookup_table(operation: str, *params) -> np.ndarray:
+    """
+    Build the 256 entry lookup table for an operation on an 8-bit channel, shared between every use of the same
+    operation and parameters
+    :param operation: The name of the operation in TABLE_OPERATIONS
+    :param params: The parameters of the operation
+    :return: The read only lookup table
+    """
+    table = (_clamp(TABLE_OPERATIONS[operation](np.arange(256) / 255.0, *params)) * 255.0).astype(np.uint8)
+    table.flags.writeable = False
+    return table
 
 
 class ColorspaceModifier:
     def __init__(self, image_handle: Image, auto_clamp: bool = True, debug: bool = False):
-        self._image_handle = image_handle
-        self._image_handle.load()
-        self._loaded_channels = None
         self._auto_clamp = auto_clamp
         self._debug = debug
+        self._image_format = None
+        self._set_image(image_handle)
+
+    def _set_image(self, image_handle: Image) -> None:
+        """
+        Validate and decode a new image, and reset everything kept from the previous image
+        :param image_handle: The image handle to use
+        """
+        if image_handle.mode not in SUPPORTED_PIL_MODES:
+            raise ValueError(f'Unsupported image format {image_handle.mode}')
+        self._image_handle = image_handle
+        self._image_handle.load()
+        self._pixels = None
+        self._lut = None
+        self._histograms = None
+        self._statistics = {}
 
-        self._image_format = self._image_handle.format
+        # Images built in memory have no file format, so keep saving in the format of the previous image
+        self._image_format = self._image_handle.format or self._image_format
         self._current_format = self._image_handle.mode
         self._output_format = self._image_handle.mode
-        if self._current_format not in SUPPORTED_PIL_MODES:
-            raise ValueError(f'Unsupported image format {self._current_format}')
 
     def set_clamp(self, auto_clamp: bool) -> None:
         """
@@ -146,22 +232,14 @@ class ColorspaceModifier:
         Load an image from a file
         :param filename: The path to the image file
         """
-        self._image_handle = Image.open(filename)
-        self._current_format = self._image_handle.mode
-        self._output_format = self._image_handle.mode
-        if self._image_format not in SUPPORTED_PIL_MODES:
-            raise ValueError(f'Unsupported image format {self._image_format}')
+        self._set_image(Image.open(filename))
 
     def set_handle(self, image_handle: Image) -> None:
         """
         Set a new image handle
         :param image_handle: The image handle to use
         """
-        self._image_handle = image_handle
-        self._current_format = self._image_handle.mode
-        self._output_format = self._image_handle.mode
-        if self._image_format not in SUPPORTED_PIL_MODES:
-            raise ValueError(f'Unsupported image format {self._image_format}')
+        self._set_image(image_handle)
 
     def _convert_image(self, new_format: str) -> None:
         """
@@ -170,6 +248,17 @@ class ColorspaceModifier:
         """
         if new_format not in SUPPORTED_PIL_MODES:
             raise ValueError(f'Unsupported image format {new_format}')
+        if self._pixels is not None and (self._current_format, new_format) in ALPHA_CONVERSIONS:
+            # Adding or dropping alpha leaves the other channels as they are, so the normalized planes are kept and the
+            # image is not written back and read again
+            if new_format.endswith('A'):
+                alpha = np.ones((1, ) + self._pixels.shape[1:], dtype=np.float32)
+                self._pixels = np.concatenate([self._pixels, alpha])
+            else:
+                self._pixels = self._pixels[:-1]
+            self._statistics = {key: stat for key, stat in self._statistics.items() if key[0] != 'A'}
+            self._current_format = new_format
+            return
         self._close_channels()
         self._image_handle = self._image_handle.convert(new_format)
         self._current_format = new_format
@@ -178,19 +267,35 @@ class ColorspaceModifier:
         """
         Close the image channels and commit them to the image
         """
-        if self._loaded_channels is not None:
-            self._image_handle = Image.merge(self._current_format, self._loaded_channels)
-            self._loaded_channels = None
+        if self._lut is not None:
+            self._image_handle = self._image_handle.point(self._lut.ravel().tolist())
+            self._lut = None
+        if self._pixels is not None:
+            # The buffer is discarded after this, so it is scaled in place. Pillow reads packed rows of interleaved
+            # channels, so the planes are cast straight into a C contiguous (H, W, C) array in one pass.
+            pixels = np.multiply(_clamp(self._pixels), np.float32(255.0), out=self._pixels)
+            data = np.empty(pixels.shape[1:] + pixels.shape[:1], dtype=np.uint8)
+            np.copyto(data.transpose(2, 0, 1), pixels, casting='unsafe')
+            self._image_handle = Image.frombuffer(self._current_format, self._image_handle.size, data, 'raw',
+                                                  self._current_format, 0, 1)
+            self._pixels = None
+            self._statistics = {}
 
     def _get_channel(self, channel: str) -> np.ndarray:
         """
-        Get the colorspace channel in a normalized format
-        :return: The normalized channel value
+        Get the colorspace channel in a normalized format. All channels are normalized together into one float32
+        buffer on first access, and kept in that form until the channels are closed, so chained operations share a
+        single read and write of the image. The buffer is laid out as (C, H, W), so each channel is a contiguous plane.
+        :return: A view of the normalized channel in the buffer
         """
-        if self._loaded_channels is None:
-            self._loaded_channels = list(self._image_handle.split())
-        ix = self._current_format.index(channel.upper())
-        return np.asarray(self._loaded_channels[ix]) / 255.0
+        if self._pixels is None:
+            self._close_channels()
+            # Cast, normalize and split the interleaved channels into planes in a single allocation
+            pixels = np.asarray(self._image_handle)
+            pixels = pixels.reshape(pixels.shape[0], pixels.shape[1], -1).transpose(2, 0, 1)
+            self._pixels = np.empty(pixels.shape, dtype=np.float32)
+            np.divide(pixels, np.float32(255.0), out=self._pixels)
+        return self._pixels[CHANNEL_INDEX[self._current_format][channel.upper()]]
 
     def _set_channel(self, channel: str, value: np.ndarray):
         """
@@ -198,14 +303,18 @@ class ColorspaceModifier:
         :param channel: The channel to set
         :param value: The value to set the channel to
         """
-        ix = self._current_format.index(channel.upper())
-        self._loaded_channels[ix] = Image.fromarray((value * 255.0).astype(np.uint8))
+        channel = channel.upper()
+        # Operations done in place on the channel view have already written to the buffer
+        if not np.may_share_memory(value, self._pixels):
+            self._pixels[CHANNEL_INDEX[self._current_format][channel]] = value
+        self._statistics = {key: stat for key, stat in self._statistics.items() if key[0] != channel}
 
-    def save_image(self, output_handle: BinaryIO, output_format: str = 'default') -> None:
+    def save_image(self, output_handle: Union[str, BinaryIO], output_format: str = 'default', compress_level: int = 6) -> None:
         """
         Save the currently loaded image to a file
-        :param output_handle: The file object to save to
+        :param output_handle: The path or file object to save to
         :param output_format: The format to save the image in
+        :param compress_level: The zlib compression level for PNG output, from 0 (fastest) to 9 (smallest)
         """
         if output_format == 'default':
             output_format = self._output_format
@@ -216,18 +325,65 @@ class ColorspaceModifier:
         if self._current_format != output_format:
             self._convert_image(output_format)
         self._close_channels()
-        self._image_handle.save(output_handle, self._image_format)
+        self._image_handle.save(output_handle, self._image_format, compress_level=compress_level)
 
-    def _pre(self, channel: str) -> tuple[np.ndarray, str]:
+    def _resolve(self, channel: str) -> str:
         """
-        Do pre-operation checks
+        Resolve a channel name to its shorthand, converting the image to a format that contains it if needed
         :param channel: The image channel in operation
+        :return: The upper case channel shorthand
         """
         if len(channel) != 1:
             channel = COLOR_CHANNEL_TO_SHORTHAND[channel.lower()]
         if channel.upper() not in self._current_format:
             self._convert_image(_get_format(self._current_format, channel.upper()))
-        return self._get_channel(channel.upper()), channel.upper()
+        return channel.upper()
+
+    def _point(self, channel: str, operation: str, *params) -> bool:
+        """
+        Apply an operation to a channel while the image is still 8-bit, through a lookup table rather than normalizing
+        the whole image. Consecutive tables are composed into one per channel table, which is applied to the image with
+        Pillow's point in a single pass when the channels are closed.
+        :param channel: The resolved image channel
+        :param operation: The name of the operation in TABLE_OPERATIONS
+        :param params: The parameters of the operation
+        :return: True if the operation was applied, False if the channels are already normalized
+        """
+        if self._pixels is not None:
+            return False
+        if self._lut is None:
+            self._lut = np.tile(np.arange(256, dtype=np.uint8), (len(self._current_format), 1))
+        ix = CHANNEL_INDEX[self._current_format][channel]
+        self._lut[ix] = _lookup_table(operation, *params)[self._lut[ix]]
+        return True
+
+    def _histogram(self, channel: str) -> np.ndarray:
+        """
+        Count the 8-bit levels of a channel that has not been normalized, including any lookup table still pending
+        :param channel: The resolved image channel
+        :return: The count of each level
+        """
+        ix = CHANNEL_INDEX[self._current_format][channel]
+        # The histograms of every channel are counted in one pass, and kept until the image itself changes
+        if self._histograms is None or self._histograms[0] is not self._image_handle:
+            self._histograms = (self._image_handle, np.asarray(self._image_handle.histogram()).reshape(-1, 256))
+        hist = self._histograms[1][ix]
+        if self._lut is not None:
+            hist = np.bincount(self._lut[ix], weights=hist, minlength=256)
+        return hist
+
+    def _statistic(self, channel: str, keyword: str, value: np.ndarray) -> float:
+        """
+        Get a keyword statistic of a normalized channel, reusing it until the channel is next set
+        :param channel: The resolved image channel
+        :param keyword: The statistic to compute
+        :param value: The normalized channel value
+        :return: The value of the statistic
+        """
+        key = (channel, keyword)
+        if key not in self._statistics:
+            self._statistics[key] = SUPPORTED_KEYWORD_PARAMS[keyword](value)
+        return self._statistics[key]
 
     def _post(self, channel: str, value: np.ndarray):
         """
@@ -245,7 +401,8 @@ class ColorspaceModifier:
         Convert the currently loaded image to a new format; Will set the output format to the new format.
         :param new_format: The PIL image format to convert to
         """
-        self._convert_image(new_format)
+        if new_format != self._current_format:
+            self._convert_image(new_format)
         self._output_format = new_format
         return self
 
@@ -255,8 +412,11 @@ class ColorspaceModifier:
         :param channels: The channel name to invert
         """
         for channel in channels:
-            v, c = self._pre(channel)
-            v = 1.0 - v
+            c = self._resolve(channel)
+            if self._point(c, 'invert'):
+                continue
+            v = self._get_channel(c)
+            np.subtract(1.0, v, out=v)
 
             self._post(c, v)
         return self
@@ -268,12 +428,18 @@ class ColorspaceModifier:
         :return: The current colorspace modifier object
         """
         for channel, color in channels:
-            v, c = self._pre(channel)
+            c = self._resolve(channel)
+            if self._pixels is None:
+                # Threshold the 8-bit channel through a lookup table, scaling the threshold to the normalized range
+                t = HISTOGRAM_KEYWORD_PARAMS[color](self._histogram(c)) / 255.0
+                self._point(c, 'threshold', t)
+                continue
+            v = self._get_channel(c)
 
-            color = SUPPORTED_KEYWORD_PARAMS[color](v)
+            color = self._statistic(c, color, v)
 
-            v[v < color] = 0
-            v[v >= color] = 1
+            # Write the comparison straight into the channel as 0 or 1, in one pass
+            np.greater_equal(v, color, out=v)
 
             self._post(c, v)
         return self
@@ -285,15 +451,23 @@ class ColorspaceModifier:
         :return: The current colorspace modifier object
         """
         for channel, mode, color in channels:
-            v, c = self._pre(channel)
+            c = self._resolve(channel)
 
             if color not in SUPPORTED_KEYWORD_PARAMS:
                 raise ValueError(f'Invalid clamp color {color}')
-            color = SUPPORTED_KEYWORD_PARAMS[color](v)
-
             if mode not in SUPPORTED_CLAMP_MODES:
                 raise ValueError(f'Invalid clamp mode {mode}')
-            v = SUPPORTED_CLAMP_MODES[mode](v, color)
+            clamp_mode = SUPPORTED_CLAMP_MODES[mode]
+
+            if self._pixels is None:
+                # Clamping an 8-bit channel to one of its own statistics keeps it in range, so it can always go
+                # through a lookup table
+                t = HISTOGRAM_KEYWORD_PARAMS[color](self._histogram(c)) / 255.0
+                self._point(c, 'clamp', mode, t)
+                continue
+            v = self._get_channel(c)
+            color = self._statistic(c, color, v)
+            clamp_mode(v, color, out=v)
 
             self._post(c, v)
         return self
@@ -305,7 +479,11 @@ class ColorspaceModifier:
         :return: The current colorspace modifier object
         """
         for channel, factor in channels:
-            v, c = self._pre(channel)
+            c = self._resolve(channel)
+            # Without auto clamp, values past the normalization range have to be carried to the next operation
+            if self._auto_clamp and self._point(c, 'scale', factor):
+                continue
+            v = self._get_channel(c)
             v *= factor
             self._post(c, v)
         return self
@@ -317,7 +495,11 @@ class ColorspaceModifier:
         :return: The current colorspace modifier object
         """
         for channel, offset in channels:
-            v, c = self._pre(channel)
+            c = self._resolve(channel)
+            # Without auto clamp, values past the normalization range have to be carried to the next operation
+            if self._auto_clamp and self._point(c, 'offset', offset):
+                continue
+            v = self._get_channel(c)
             v += offset
             self._post(c, v)
         return self